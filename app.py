@@ -3,12 +3,32 @@ import subprocess
 import pathlib
 import sys
 import os
+import time
 import io
+import codecs
+import functools
+import queue
+import re
+import shutil
 import zipfile
 import tempfile
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator
 
 from dotenv import load_dotenv
 
+# Run the scripts in-process when they import cleanly; otherwise fall back
+# to launching them as subprocesses.
+try:
+    import main as download_script
+    import upload_marked as upload_script
+except Exception:
+    download_script = None
+    upload_script = None
+
 # ----------------------------
 # Configuration
 # ----------------------------
@@ -21,23 +41,35 @@ st.set_page_config(
 ROOT = pathlib.Path(__file__).resolve().parent
 DOWNLOADS_DIR = ROOT / "downloads"
 
-REQUIRED_ENV_VARS = [
+REQUIRED_ENV_VARS = (
     "WISE_API_KEY",
     "WISE_NAMESPACE",
     "WISE_INSTITUTE_ID",
     "WISE_BASIC_USER",
     "WISE_BASIC_PASS",
-]
+)
+
+# Uploads must end in " Marked.pdf" (any case)
+MARKED_NAME_RE = re.compile(r" marked\.pdf\Z", re.IGNORECASE)
+
+# Parallel file reads when building the download ZIP
+ZIP_READ_WORKERS = 8
+
+# Minimum seconds between live log refreshes while a script is running
+OUTPUT_REFRESH_INTERVAL = 0.2
+# Number of trailing output lines shown while a script is running
+OUTPUT_TAIL_LINES = 50
+# Bytes read from a script's stdout pipe per read
+PIPE_CHUNK_SIZE = 64 * 1024
 
 
 # ----------------------------
 # Credential Loading
 # ----------------------------
-def load_credentials() -> bool:
+@st.cache_resource(show_spinner=False)
+def _load_credentials_once() -> bool:
     try:
-        for key in REQUIRED_ENV_VARS:
-            if key in st.secrets:
-                os.environ[key] = st.secrets[key]
+        os.environ.update({k: st.secrets[k] for k in REQUIRED_ENV_VARS if k in st.secrets})
     except Exception:
         pass
 
@@ -49,6 +81,18 @@ def load_credentials() -> bool:
     return len(missing) == 0
 
 
+def load_credentials() -> bool:
+    """Load secrets/.env into the environment once per process."""
+    env = os.environ
+    if all(env.get(k) for k in REQUIRED_ENV_VARS):
+        return True
+    if _load_credentials_once():
+        return True
+    # Don't pin a failure: look again on the next rerun once config is added
+    _load_credentials_once.clear()
+    return False
+
+
 def get_missing_credentials() -> list[str]:
     return [k for k in REQUIRED_ENV_VARS if not os.environ.get(k)]
 
@@ -56,34 +100,98 @@ def get_missing_credentials() -> list[str]:
 # ----------------------------
 # Helper Functions
 # ----------------------------
-def get_download_folders() -> list[pathlib.Path]:
-    if not DOWNLOADS_DIR.exists():
-        return []
-    return sorted(DOWNLOADS_DIR.glob("Downloaded_*"), reverse=True)
+@st.cache_data(ttl=5, show_spinner=False)
+def _scan_latest_download_folder(downloads_dir: str, mtime_ns: int) -> pathlib.Path | None:
+    """Find the newest Downloaded_* folder in one pass; mtime_ns is only part of the cache key."""
+    best = None
+    with os.scandir(downloads_dir) as it:
+        for e in it:
+            if (
+                e.name.startswith("Downloaded_")
+                and (best is None or e.name > best.name)
+                and e.is_dir(follow_symlinks=False)
+            ):
+                best = e
+    return pathlib.Path(best.path) if best else None
+
+
+@st.cache_data(ttl=5, show_spinner=False)
+def _scan_pdf_files(folder: str, mtime_ns: int) -> list[str]:
+    """List non-marked PDF names; mtime_ns is only part of the cache key."""
+    with os.scandir(folder) as it:
+        return [
+            e.name
+            for e in it
+            if e.name.lower().endswith(".pdf")
+            and not e.name.startswith("_")
+            and "Marked" not in e.name
+            and e.is_file(follow_symlinks=False)
+        ]
+
+
+@st.cache_data(ttl=5, show_spinner=False)
+def _scan_zip_files(folder: str, mtime_ns: int) -> list[str]:
+    """List every PDF to archive, marked or not; mtime_ns is only part of the cache key."""
+    with os.scandir(folder) as it:
+        return [
+            e.name
+            for e in it
+            if e.name.lower().endswith(".pdf")
+            and not e.name.startswith("_")
+            and e.is_file(follow_symlinks=False)
+        ]
 
 
 def get_latest_download_folder() -> pathlib.Path | None:
-    folders = get_download_folders()
-    return folders[0] if folders else None
+    try:
+        mtime_ns = DOWNLOADS_DIR.stat().st_mtime_ns
+        return _scan_latest_download_folder(str(DOWNLOADS_DIR), mtime_ns)
+    except OSError:
+        return None
 
 
-def get_pdf_files(folder: pathlib.Path) -> list[pathlib.Path]:
-    """Get all non-marked PDFs in folder."""
-    if not folder or not folder.exists():
+def get_pdf_files(folder: pathlib.Path) -> list[str]:
+    """Get the names of all non-marked PDFs in folder."""
+    if not folder:
+        return []
+    try:
+        mtime_ns = folder.stat().st_mtime_ns
+        return _scan_pdf_files(str(folder), mtime_ns)
+    except OSError:
         return []
-    return [f for f in folder.glob("*.pdf") if not f.name.startswith("_") and "Marked" not in f.name]
 
 
-def make_zip(folder: pathlib.Path) -> bytes:
-    """Zip all PDFs in folder and return as bytes."""
+def _read_zip_entry(path: pathlib.Path) -> tuple[zipfile.ZipInfo, bytes] | None:
+    """Read one file for the archive, or None if it vanished or can't be read."""
+    try:
+        return zipfile.ZipInfo.from_file(path, path.name), path.read_bytes()
+    except OSError:
+        return None
+
+
+def make_zip(folder: pathlib.Path, pdf_names: list[str]) -> bytes:
+    """Zip the named PDFs from folder and return as bytes.
+
+    PDFs are already compressed internally, so entries are stored as-is.
+    Files that disappear or can't be read are left out.
+    """
+    paths = [folder / name for name in pdf_names]
     buf = io.BytesIO()
-    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
-        for pdf in folder.glob("*.pdf"):
-            if not pdf.name.startswith("_"):
-                zf.write(pdf, pdf.name)
+    # Read files on a small pool so disk latency overlaps with zip writes
+    with ThreadPoolExecutor(max_workers=ZIP_READ_WORKERS) as pool, \
+            zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zf:
+        for entry in pool.map(_read_zip_entry, paths):
+            if entry is not None:
+                zf.writestr(*entry)
     return buf.getvalue()
 
 
+@st.cache_data(max_entries=2, show_spinner=False)
+def get_folder_zip(folder: str, mtime_ns: int) -> bytes:
+    """Zip a folder's PDFs once per folder version; mtime_ns is only part of the cache key."""
+    return make_zip(pathlib.Path(folder), _scan_zip_files(folder, mtime_ns))
+
+
 def run_script(script_name: str, args: list[str] | None = None) -> bool:
     script_path = ROOT / script_name
     if not script_path.exists():
@@ -99,26 +207,134 @@ def run_script(script_name: str, args: list[str] | None = None) -> bool:
         cwd=str(ROOT),
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
-        text=True,
-        bufsize=1,
+        bufsize=PIPE_CHUNK_SIZE,
+        env={**os.environ, "PYTHONUNBUFFERED": "1", "PYTHONIOENCODING": "utf-8"},
+    )
+
+    show_output(iter_pipe_lines(proc.stdout))
+    proc.wait()
+    return report_result(proc.returncode)
+
+
+def iter_pipe_lines(pipe) -> Iterator[str]:
+    """Yield decoded lines from a binary pipe, decoding whatever is available per read."""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    tail = ""
+    while True:
+        chunk = pipe.read1(PIPE_CHUNK_SIZE)
+        if not chunk:
+            break
+        parts = (tail + decoder.decode(chunk)).split("\n")
+        tail = parts.pop()
+        yield from parts
+    tail += decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def run_in_background(func: Callable[..., int], *args) -> bool:
+    """Run a script's run() in a worker thread, streaming its log lines."""
+    log_queue: queue.Queue[str | None] = queue.Queue()
+    result = {"code": 1}
+
+    def worker():
+        try:
+            result["code"] = func(*args, log=log_queue.put)
+        except Exception:
+            log_queue.put(traceback.format_exc())
+        finally:
+            log_queue.put(None)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    show_output(
+        line
+        for message in iter(log_queue.get, None)
+        for line in (str(message).splitlines() or [""])
     )
+    thread.join()
+    return report_result(result["code"])
+
 
+def show_output(stream: Iterable[str]) -> None:
+    """Show the tail of a script's output, refreshing at most every interval."""
     output_box = st.empty()
-    lines = []
-    for line in proc.stdout:
+    lines = deque(maxlen=OUTPUT_TAIL_LINES)
+    last_refresh = 0.0
+    for line in stream:
         lines.append(line.rstrip())
-        output_box.code("\n".join(lines[-50:]), language="text")
+        now = time.monotonic()
+        if now - last_refresh >= OUTPUT_REFRESH_INTERVAL:
+            output_box.code("\n".join(lines), language="text")
+            last_refresh = now
 
-    proc.wait()
+    output_box.code("\n".join(lines), language="text")
 
-    if proc.returncode == 0:
+
+def report_result(returncode: int) -> bool:
+    if returncode == 0:
         st.success("Done!")
         return True
     else:
-        st.error(f"Failed (exit code {proc.returncode})")
+        st.error(f"Failed (exit code {returncode})")
         return False
 
 
+# ----------------------------
+# Step 1 (fragment)
+# ----------------------------
+@st.fragment
+def download_step():
+    """Step 1 reruns on its own, so a download doesn't redraw the whole page."""
+    st.subheader("Step 1 — Download Submissions")
+
+    days_options = {
+        "Last 1 day": 1,
+        "Last 2 days": 2,
+        "Last 3 days": 3,
+        "Last 4 days": 4,
+        "Last 5 days": 5,
+        "Last 6 days": 6,
+        "Last 7 days": 7,
+        "Last 14 days": 14,
+        "Last 30 days": 30,
+    }
+    selected_label = st.selectbox("Time period", list(days_options.keys()), index=6)
+    days_back = days_options[selected_label]
+    resume = st.checkbox(
+        "Resume (reuse data fetched in the last 15 minutes)",
+        help="Faster retry after a failed download. Leave off to pick up new submissions.",
+    )
+
+    if st.button(f"Download ({selected_label})", use_container_width=True, type="primary"):
+        with st.spinner("Fetching submissions from Wise..."):
+            if download_script is not None:
+                run_in_background(functools.partial(download_script.run, use_cache=resume), days_back)
+            else:
+                run_script("main.py", [str(days_back)] + (["--resume"] if resume else []))
+
+    latest_folder = get_latest_download_folder()
+    if latest_folder:
+        pdfs = get_pdf_files(latest_folder)
+        st.caption(f"Latest folder: **{latest_folder.name}** — {len(pdfs)} file(s)")
+
+        if pdfs:
+            try:
+                zip_bytes = get_folder_zip(str(latest_folder), latest_folder.stat().st_mtime_ns)
+            except OSError as e:
+                st.warning(f"Could not build the ZIP for {latest_folder.name}: {e}")
+                return
+            st.download_button(
+                label=f"Download ZIP ({len(pdfs)} PDFs)",
+                data=zip_bytes,
+                file_name=f"{latest_folder.name}.zip",
+                mime="application/zip",
+                use_container_width=True,
+            )
+        else:
+            st.info("No submissions found in the latest folder. Try downloading again.")
+
+
 # ----------------------------
 # Main App
 # ----------------------------
@@ -174,44 +390,7 @@ def main():
 
     st.divider()
 
-    # ---- STEP 1: DOWNLOAD ----
-    st.subheader("Step 1 — Download Submissions")
-
-    days_options = {
-        "Last 1 day": 1,
-        "Last 2 days": 2,
-        "Last 3 days": 3,
-        "Last 4 days": 4,
-        "Last 5 days": 5,
-        "Last 6 days": 6,
-        "Last 7 days": 7,
-        "Last 14 days": 14,
-        "Last 30 days": 30,
-    }
-    selected_label = st.selectbox("Time period", list(days_options.keys()), index=6)
-    days_back = days_options[selected_label]
-
-    if st.button(f"Download ({selected_label})", use_container_width=True, type="primary"):
-        with st.spinner("Fetching submissions from Wise..."):
-            run_script("main.py", [str(days_back)])
-        st.rerun()
-
-    latest_folder = get_latest_download_folder()
-    if latest_folder:
-        pdfs = get_pdf_files(latest_folder)
-        st.caption(f"Latest folder: **{latest_folder.name}** — {len(pdfs)} file(s)")
-
-        if pdfs:
-            zip_bytes = make_zip(latest_folder)
-            st.download_button(
-                label=f"Download ZIP ({len(pdfs)} PDFs)",
-                data=zip_bytes,
-                file_name=f"{latest_folder.name}.zip",
-                mime="application/zip",
-                use_container_width=True,
-            )
-        else:
-            st.info("No submissions found in the latest folder. Try downloading again.")
+    download_step()
 
     st.divider()
 
@@ -234,14 +413,20 @@ def main():
 
     if uploaded_files:
         # Check naming
-        bad_names = [f.name for f in uploaded_files if not f.name.lower().endswith(" marked.pdf")]
+        good_files = []
+        bad_names = []
+        for f in uploaded_files:
+            if MARKED_NAME_RE.search(f.name):
+                good_files.append(f)
+            else:
+                bad_names.append(f.name)
+
         if bad_names:
             st.warning(
                 f"{len(bad_names)} file(s) don't end with ` Marked.pdf` and will be skipped:\n"
                 + "\n".join(f"- {n}" for n in bad_names)
             )
 
-        good_files = [f for f in uploaded_files if f.name.lower().endswith(" marked.pdf")]
         st.write(f"Ready to upload: **{len(good_files)}** marked file(s)")
 
         if good_files and st.button("Upload to Wise", use_container_width=True, type="primary"):
@@ -250,10 +435,14 @@ def main():
 
                 # Save uploaded files to temp folder
                 for uf in good_files:
-                    (tmp_path / uf.name).write_bytes(uf.read())
+                    with open(tmp_path / uf.name, "wb") as dst:
+                        shutil.copyfileobj(uf, dst, length=1 << 20)
 
                 with st.spinner(f"Uploading {len(good_files)} file(s) to Wise..."):
-                    run_script("upload_marked.py", [str(tmp_path)])
+                    if upload_script is not None:
+                        run_in_background(upload_script.run, tmp_path)
+                    else:
+                        run_script("upload_marked.py", [str(tmp_path)])
     else:
         st.info("No files selected yet.")
 
@@ -1,18 +1,38 @@
 from __future__ import annotations
 
+import io
 import os
 import re
 import sys
+import time
+import hashlib
+import threading
 import base64
+import functools
+import shutil
 import pathlib
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta, timezone
+from typing import Callable
 from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 from dateutil import parser as dateparser
 from PIL import Image
 
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+try:
+    import img2pdf
+except ImportError:
+    img2pdf = None
+
 # ---- Load .env reliably (Windows-safe) ----
 SCRIPT_DIR = pathlib.Path(__file__).resolve().parent
 ENV_PATH = SCRIPT_DIR / ".env"
@@ -21,14 +41,59 @@ load_dotenv(dotenv_path=ENV_PATH)
 WISE_BASE = "https://na-api.wiseapp.live"
 UA = "VendorIntegrations/jmcg-maths-mentors"
 
-DOWNLOAD_TIMESTAMP = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-DOWNLOAD_ROOT = SCRIPT_DIR / "downloads" / f"Downloaded_{DOWNLOAD_TIMESTAMP}"
+# One keep-alive connection pool for every request this module makes.
+# It lives as long as the module, so repeated runs from the app reuse it.
+# Transient failures on idempotent requests are retried with exponential
+# backoff; the last response is returned so raise_for_status still applies.
+RETRY = Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset({"GET"}),
+    raise_on_status=False,
+)
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=RETRY))
+
+DOWNLOADS_DIR = SCRIPT_DIR / "downloads"
+
+# Opt-in (run(use_cache=True) / --resume / the app's "Resume" box): assessment
+# payloads are reused for a short while so a retry straight after a failure
+# doesn't refetch everything. Off by default since a cached copy hides new
+# submissions and stale file URLs. Expired entries are removed on every run.
+ASSESSMENT_CACHE_DIR = DOWNLOADS_DIR / "_cache"
+ASSESSMENT_CACHE_TTL = 15 * 60  # seconds
 
 # Can be overridden via CLI argument: python main.py <days>
-DAYS_BACK = int(sys.argv[1]) if len(sys.argv) > 1 else 7
+DEFAULT_DAYS_BACK = 7
 DEBUG = False
 
-IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".webp"}
+# Concurrent API fetches / file downloads (keep <= the session pool size)
+DOWNLOAD_WORKERS = 16
+
+IMAGE_EXTS = frozenset({".png", ".jpg", ".jpeg", ".webp"})
+
+# Attachment "type" values that identify a PDF / an image
+PDF_TYPE_TOKENS = frozenset({"pdf"})
+IMAGE_TYPE_TOKENS = frozenset({"image", "png", "jpg", "jpeg", "webp"})
+
+# Top-level submission-time keys, checked in order before any deep search
+SUBMITTED_AT_KEYS = ("submittedAt", "submittedOn", "submissionTime", "submitted_at")
+
+# Keys that may hold a timestamp anywhere in a submission (see find_any_timestamp)
+TIMESTAMP_KEYS = frozenset({
+    "submittedAt", "submitted_at", "submissionTime", "submittedOn",
+    "createdAt", "updatedAt", "time", "timestamp", "date",
+})
+
+# Timeline keys holding assessment ids (see extract_assessment_ids): the
+# entity's own id keys when it is an assessment, and reference keys anywhere
+ASSESSMENT_REF_KEYS = frozenset({"assessmentId", "assignment_id", "assignmentId"})
+ASSESSMENT_ENTITY_ID_KEYS = frozenset({"_id", "id"}) | ASSESSMENT_REF_KEYS
+
+# Filename sanitising (see safe_part)
+UNSAFE_CHARS_RE = re.compile(r'[<>:"/\\|?*\n\r\t]+')
+WHITESPACE_RE = re.compile(r"\s+")
 
 REQUIRED_ENV_VARS = [
     "WISE_API_KEY",
@@ -39,25 +104,30 @@ REQUIRED_ENV_VARS = [
 ]
 
 
-def validate_env() -> None:
+def validate_env(log: Callable[[str], None] = print) -> bool:
     """Check all required environment variables are set."""
     missing = [k for k in REQUIRED_ENV_VARS if not os.environ.get(k)]
     if missing:
-        print(f"ERROR: Missing environment variables: {', '.join(missing)}")
-        print("Please check your .env file or Streamlit secrets configuration.")
-        sys.exit(1)
+        log(f"ERROR: Missing environment variables: {', '.join(missing)}")
+        log("Please check your .env file or Streamlit secrets configuration.")
+        return False
+    return True
 
 
 # ----------------------------
 # Auth + headers
 # ----------------------------
-def _basic_auth_header() -> str:
-    user = os.environ["WISE_BASIC_USER"]
-    pw = os.environ["WISE_BASIC_PASS"]
+@functools.lru_cache(maxsize=1)
+def _encode_basic_auth(user: str, pw: str) -> str:
     token = base64.b64encode(f"{user}:{pw}".encode("utf-8")).decode("utf-8")
     return f"Basic {token}"
 
 
+def _basic_auth_header() -> str:
+    # Keyed on the credentials, so a changed env still yields a fresh header
+    return _encode_basic_auth(os.environ["WISE_BASIC_USER"], os.environ["WISE_BASIC_PASS"])
+
+
 def wise_headers(content_type: bool = True) -> dict:
     h = {
         "User-Agent": UA,
@@ -72,9 +142,9 @@ def wise_headers(content_type: bool = True) -> dict:
 
 def wise_get(path: str, params: dict | None = None) -> dict:
     url = f"{WISE_BASE}{path}"
-    r = requests.get(url, headers=wise_headers(content_type=False), params=params, timeout=60)
+    r = SESSION.get(url, headers=wise_headers(content_type=False), params=params, timeout=60)
     r.raise_for_status()
-    return r.json()
+    return _json.loads(r.content)
 
 
 # ----------------------------
@@ -107,8 +177,51 @@ def get_content_timeline(class_id: str) -> dict:
     )
 
 
-def get_assessment(assessment_id: str) -> dict:
-    return wise_get(f"/user/getAssessment/{assessment_id}")
+def get_assessment(assessment_id: str, use_cache: bool = False) -> dict:
+    """
+    Fetch an assessment. With use_cache, reuse a copy saved by a run in the
+    last ASSESSMENT_CACHE_TTL seconds and save fresh ones for the next run.
+    """
+    if not use_cache:
+        return wise_get(f"/user/getAssessment/{assessment_id}")
+
+    cache_key = hashlib.sha1(assessment_id.encode("utf-8")).hexdigest()
+    cache_path = ASSESSMENT_CACHE_DIR / f"{cache_key}.json"
+    try:
+        if time.time() - cache_path.stat().st_mtime < ASSESSMENT_CACHE_TTL:
+            return _json.loads(cache_path.read_bytes())
+    except (OSError, ValueError):
+        pass
+
+    data = wise_get(f"/user/getAssessment/{assessment_id}")
+
+    try:
+        payload = _json.dumps(data)
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        ASSESSMENT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # write-then-rename so a concurrent reader never sees a partial file
+        tmp_path = cache_path.with_name(f"{cache_key}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(payload)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+    return data
+
+
+def prune_assessment_cache() -> None:
+    """Delete cached assessments (and stray temp files) older than the TTL."""
+    cutoff = time.time() - ASSESSMENT_CACHE_TTL
+    try:
+        with os.scandir(ASSESSMENT_CACHE_DIR) as it:
+            for e in it:
+                try:
+                    if e.is_file(follow_symlinks=False) and e.stat().st_mtime < cutoff:
+                        os.remove(e.path)
+                except OSError:
+                    pass
+    except OSError:
+        pass
 
 
 # ----------------------------
@@ -116,12 +229,28 @@ def get_assessment(assessment_id: str) -> dict:
 # ----------------------------
 def safe_part(s: str, max_len: int = 60) -> str:
     s = (s or "").strip()
-    s = re.sub(r'[<>:"/\\|?*\n\r\t]+', " ", s)
-    s = re.sub(r"\s+", " ", s).strip()
+    s = UNSAFE_CHARS_RE.sub(" ", s)
+    s = WHITESPACE_RE.sub(" ", s).strip()
     s = s.replace("__", "_")
     return s[:max_len] if len(s) > max_len else s
 
 
+@functools.lru_cache(maxsize=8192)
+def _parse_dt_str(value: str) -> datetime | None:
+    # The same timestamp strings recur across submissions, so parses are memoised
+    try:
+        # Wise sends ISO-8601; only fall back to dateutil for anything else
+        try:
+            dt = datetime.fromisoformat(value[:-1] + "+00:00" if value.endswith("Z") else value)
+        except ValueError:
+            dt = dateparser.parse(value)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return dt.astimezone(timezone.utc)
+    except Exception:
+        return None
+
+
 def parse_dt(value) -> datetime | None:
     if not value:
         return None
@@ -130,36 +259,32 @@ def parse_dt(value) -> datetime | None:
             return datetime.fromtimestamp(value / 1000, tz=timezone.utc)
         return datetime.fromtimestamp(value, tz=timezone.utc)
     if isinstance(value, str):
-        try:
-            dt = dateparser.parse(value)
-            if dt.tzinfo is None:
-                dt = dt.replace(tzinfo=timezone.utc)
-            return dt.astimezone(timezone.utc)
-        except Exception:
-            return None
+        return _parse_dt_str(value)
     return None
 
 
 def find_any_timestamp(obj: dict) -> datetime | None:
-    COMMON_KEYS = (
-        "submittedAt", "submitted_at", "submissionTime", "submittedOn",
-        "createdAt", "updatedAt", "time", "timestamp", "date",
-    )
+    # Fast path: a top-level submission time is authoritative
+    if isinstance(obj, dict):
+        for k in SUBMITTED_AT_KEYS:
+            dt = parse_dt(obj.get(k))
+            if dt:
+                return dt
+
     found: list[datetime] = []
 
-    def walk(x):
+    stack = [obj]
+    while stack:
+        x = stack.pop()
         if isinstance(x, dict):
-            for k in COMMON_KEYS:
-                dt = parse_dt(x.get(k))
+            for k in TIMESTAMP_KEYS.intersection(x):
+                dt = parse_dt(x[k])
                 if dt:
                     found.append(dt)
-            for v in x.values():
-                walk(v)
+            stack.extend(x.values())
         elif isinstance(x, list):
-            for v in x:
-                walk(v)
+            stack.extend(x)
 
-    walk(obj)
     return max(found) if found else None
 
 
@@ -198,75 +323,124 @@ def extract_student_name(sub: dict) -> str:
 def extract_assessment_ids(timeline: dict) -> list[str]:
     ids: set[str] = set()
 
-    def walk(x):
+    stack = [timeline]
+    while stack:
+        x = stack.pop()
         if isinstance(x, dict):
             et = str(x.get("entityType") or x.get("type") or x.get("contentType") or "").lower()
             if "assessment" in et or "assignment" in et or "homework" in et:
-                for k in ("_id", "id", "assessmentId", "assignment_id", "assignmentId"):
-                    vv = x.get(k)
+                for k in ASSESSMENT_ENTITY_ID_KEYS.intersection(x):
+                    vv = x[k]
                     if vv:
                         ids.add(str(vv))
-            for k in ("assessmentId", "assignment_id", "assignmentId"):
-                vv = x.get(k)
+            for k in ASSESSMENT_REF_KEYS.intersection(x):
+                vv = x[k]
                 if vv:
                     ids.add(str(vv))
-            for v in x.values():
-                walk(v)
+            stack.extend(x.values())
         elif isinstance(x, list):
-            for v in x:
-                walk(v)
+            stack.extend(x)
 
-    walk(timeline)
     return sorted(ids)
 
 
-SUBMISSION_HINT_KEYS = {"studentId", "student_id", "submissionId", "submission_id", "attachments", "files", "submittedAt"}
+SUBMISSION_HINT_KEYS = frozenset({
+    "studentId", "student_id", "submissionId", "submission_id", "attachments", "files", "submittedAt",
+})
 
 
-def find_submission_lists_anywhere(obj) -> list[tuple[str, list[dict]]]:
-    matches: list[tuple[str, list[dict]]] = []
+def find_submission_lists_anywhere(obj) -> list[list[dict]]:
+    matches: list[list[dict]] = []
 
     def looks_like_submission_dict(d: dict) -> bool:
-        keys = set(d.keys())
-        return any(k in keys for k in SUBMISSION_HINT_KEYS)
+        return not SUBMISSION_HINT_KEYS.isdisjoint(d)
 
-    def walk(x, path: str):
+    # Children are pushed in reverse so matches keep depth-first document order
+    stack = [obj]
+    while stack:
+        x = stack.pop()
         if isinstance(x, dict):
-            for k, v in x.items():
-                walk(v, f"{path}.{k}" if path else str(k))
+            stack.extend(reversed(x.values()))
         elif isinstance(x, list):
             if x and all(isinstance(i, dict) for i in x):
                 score = sum(1 for i in x[:10] if looks_like_submission_dict(i))
                 if score > 0:
-                    matches.append((path, x))
-            for i, v in enumerate(x):
-                walk(v, f"{path}[{i}]")
+                    matches.append(x)
+            stack.extend(reversed(x))
 
-    walk(obj, "")
     return matches
 
 
-def unique_path(base_dir: pathlib.Path, desired_name: str) -> pathlib.Path:
-    p = base_dir / desired_name
-    if not p.exists():
-        return p
-    stem = p.stem
-    suffix = p.suffix
-    for i in range(2, 9999):
-        candidate = base_dir / f"{stem} ({i}){suffix}"
-        if not candidate.exists():
-            return candidate
-    return base_dir / f"{stem} ({int(datetime.now().timestamp())}){suffix}"
+def unique_path(
+    base_dir: pathlib.Path,
+    desired_name: str,
+    taken: set[str] | None = None,
+) -> pathlib.Path:
+    """
+    Pick a free file name in base_dir without a stat per candidate.
+    taken holds casefolded names already in use (defaults to one listing
+    of base_dir); the chosen name is added to it.
+    """
+    if taken is None:
+        taken = {n.casefold() for n in os.listdir(base_dir)} if base_dir.is_dir() else set()
+
+    name = desired_name
+    if name.casefold() in taken:
+        desired = pathlib.PurePath(desired_name)
+        stem = desired.stem
+        suffix = desired.suffix
+        for i in range(2, 9999):
+            name = f"{stem} ({i}){suffix}"
+            if name.casefold() not in taken:
+                break
+        else:
+            name = f"{stem} ({int(datetime.now().timestamp())}){suffix}"
+    taken.add(name.casefold())
+    return base_dir / name
+
+
+def part_path(path: pathlib.Path) -> pathlib.Path:
+    """
+    Temp name to write path under. The leading underscore keeps it out of
+    the app's folder listings until it's renamed into place, so a half-written
+    file is never picked up (or zipped).
+    """
+    return path.with_name(f"_{path.name}.part")
 
 
 def download_url(url: str, out_path: pathlib.Path) -> None:
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    with requests.get(url, stream=True, timeout=180) as r:
+    """Stream url to out_path. The parent folder must already exist."""
+    tmp_path = part_path(out_path)
+    try:
+        with SESSION.get(url, stream=True, timeout=180) as r:
+            r.raise_for_status()
+            r.raw.decode_content = True
+            with open(tmp_path, "wb") as f:
+                shutil.copyfileobj(r.raw, f, length=1024 * 1024)
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def copy_file(src: pathlib.Path, dst: pathlib.Path) -> None:
+    """
+    Copy src to dst (via a _*.part name, like download_url). A real copy,
+    not a link, so annotating one student's file never changes another's.
+    """
+    tmp_path = part_path(dst)
+    try:
+        shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def download_bytes(url: str) -> bytes:
+    with SESSION.get(url, timeout=180) as r:
         r.raise_for_status()
-        with open(out_path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=1024 * 256):
-                if chunk:
-                    f.write(chunk)
+        return r.content
 
 
 # ----------------------------
@@ -301,12 +475,13 @@ def extract_attachments(sub: dict) -> list[dict]:
         if not isinstance(url, str) or not url.startswith("http"):
             continue
 
-        # determine kind
-        ext = pathlib.Path(fname).suffix.lower() if fname else pathlib.Path(urlparse(url).path).suffix.lower()
+        # determine kind (parse the URL only when there's no filename, and only once)
+        url_name = "" if fname else pathlib.Path(urlparse(url).path).name
+        ext = pathlib.Path(fname or url_name).suffix.lower()
         kind = None
-        if a_type == "pdf" or ext == ".pdf":
+        if a_type in PDF_TYPE_TOKENS or ext == ".pdf":
             kind = "pdf"
-        elif a_type in ("image", "png", "jpg", "jpeg", "webp") or ext in IMAGE_EXTS:
+        elif a_type in IMAGE_TYPE_TOKENS or ext in IMAGE_EXTS:
             kind = "image"
         else:
             continue
@@ -323,7 +498,7 @@ def extract_attachments(sub: dict) -> list[dict]:
             seen_names.add(keyname)
 
         if not fname:
-            fname = pathlib.Path(urlparse(url).path).name or f"attachment{ext or ''}"
+            fname = url_name or f"attachment{ext or ''}"
 
         picked.append({"kind": kind, "url": url, "filename": fname, "s3Key": s3key})
 
@@ -333,167 +508,234 @@ def extract_attachments(sub: dict) -> list[dict]:
 # ----------------------------
 # Image -> PDF
 # ----------------------------
-def images_to_pdf(image_paths: list[pathlib.Path], out_pdf: pathlib.Path) -> None:
+def _has_transparency(img: Image.Image) -> bool:
+    return img.mode in ("RGBA", "LA") or "transparency" in img.info
+
+
+def _flatten_to_rgb(img: Image.Image) -> Image.Image:
+    """Convert to RGB, compositing any transparency onto white."""
+    if _has_transparency(img):
+        img = img.convert("RGBA")
+        bg = Image.new("RGB", img.size, (255, 255, 255))
+        bg.paste(img, mask=img.split()[-1])
+        return bg
+    return img.convert("RGB")
+
+
+def images_to_pdf(images: list[bytes], out_pdf: pathlib.Path) -> None:
     """
-    Combine images into a multi-page PDF using Pillow.
+    Combine encoded images (file bytes) into a multi-page PDF.
+    With img2pdf, JPEG bytes are embedded as-is; only images with
+    transparency are flattened first. Falls back to Pillow without it.
     """
-    if not image_paths:
+    if not images:
         return
 
-    # open all and convert to RGB
-    imgs = []
-    for p in image_paths:
-        img = Image.open(p)
-        # If image has alpha, convert properly
-        if img.mode in ("RGBA", "LA"):
-            bg = Image.new("RGB", img.size, (255, 255, 255))
-            bg.paste(img, mask=img.split()[-1])
-            img = bg
-        else:
-            img = img.convert("RGB")
-        imgs.append(img)
-
-    first, rest = imgs[0], imgs[1:]
     out_pdf.parent.mkdir(parents=True, exist_ok=True)
-    first.save(out_pdf, save_all=True, append_images=rest)
+    tmp_pdf = part_path(out_pdf)
+    try:
+        _write_images_pdf(images, tmp_pdf)
+        os.replace(tmp_pdf, out_pdf)
+    except BaseException:
+        tmp_pdf.unlink(missing_ok=True)
+        raise
+
+
+def _write_images_pdf(images: list[bytes], out_pdf: pathlib.Path) -> None:
+    if img2pdf is None:
+        imgs = [_flatten_to_rgb(Image.open(io.BytesIO(data))) for data in images]
+        first, rest = imgs[0], imgs[1:]
+        first.save(out_pdf, format="PDF", save_all=True, append_images=rest)
+        return
+
+    # img2pdf rejects alpha channels, so flatten just those pages to PNG
+    pages: list[bytes] = []
+    for data in images:
+        with Image.open(io.BytesIO(data)) as img:
+            if _has_transparency(img):
+                buf = io.BytesIO()
+                _flatten_to_rgb(img).save(buf, format="PNG")
+                pages.append(buf.getvalue())
+            else:
+                pages.append(data)
+
+    with open(out_pdf, "wb") as f:
+        img2pdf.convert(pages, rotation=img2pdf.Rotation.ifvalid, outputstream=f)
 
 
 # ----------------------------
 # Main: one folder, PDFs + images-as-PDF
 # ----------------------------
-def main():
-    validate_env()
+def run(
+    days_back: int = DEFAULT_DAYS_BACK,
+    log: Callable[[str], None] = print,
+    use_cache: bool = False,
+) -> int:
+    """
+    Download recent submissions into a new Downloaded_* folder.
+    use_cache reuses recently fetched assessments (see ASSESSMENT_CACHE_TTL).
+    Returns a process-style exit code (0 on success).
+    """
+    if not validate_env(log):
+        return 1
+    prune_assessment_cache()
     institute_id = os.environ["WISE_INSTITUTE_ID"]
-    since = datetime.now(timezone.utc) - timedelta(days=DAYS_BACK)
+    since = datetime.now(timezone.utc) - timedelta(days=days_back)
 
-    DOWNLOAD_ROOT.mkdir(parents=True, exist_ok=True)
+    download_timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    download_root = DOWNLOADS_DIR / f"Downloaded_{download_timestamp}"
+    download_root.mkdir(parents=True, exist_ok=True)
 
     classes = get_live_classes(institute_id)
-    print(f"LIVE classes found: {len(classes)}")
-    print(f"Download folder: {DOWNLOAD_ROOT.resolve()}")
-    print(f"Since (UTC): {since.isoformat()}")
-    print("PDF-only output: ON (PDFs download; images get combined into a PDF)")
+    log(f"LIVE classes found: {len(classes)}")
+    log(f"Download folder: {download_root.resolve()}")
+    log(f"Since (UTC): {since.isoformat()}")
+    log("PDF-only output: ON (PDFs download; images get combined into a PDF)")
 
     downloaded_pdfs = 0
     created_image_pdfs = 0
     ignored_no_files = 0
 
-    for c in classes:
-        class_id = str(c.get("_id") or c.get("id") or "")
-        class_name = safe_part(c.get("name") or c.get("className") or f"class_{class_id}", max_len=50)
-        if not class_id:
-            continue
-
-        timeline = get_content_timeline(class_id)
-        assessment_ids = extract_assessment_ids(timeline)
-
-        if DEBUG:
-            print(f"\n[DEBUG] Class {class_name} -> assessment ids: {len(assessment_ids)}")
+    # Names handed out this run (casefolded, as Windows paths are case-insensitive);
+    # downloads finish later, so the directory itself can't be checked for clashes
+    taken = {n.casefold() for n in os.listdir(download_root)}
 
-        for aid in assessment_ids:
-            assessment = get_assessment(aid)
+    # s3Key -> first download of that PDF this run; later copies reuse it
+    pdf_by_key: dict[str, tuple[Future, pathlib.Path]] = {}
+    fetch_assessment = functools.partial(get_assessment, use_cache=use_cache)
 
-            candidate_lists = find_submission_lists_anywhere(assessment)
-            if not candidate_lists:
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+        for c in classes:
+            class_id = str(c.get("_id") or c.get("id") or "")
+            class_name = safe_part(c.get("name") or c.get("className") or f"class_{class_id}", max_len=50)
+            if not class_id:
                 continue
 
-            candidate_lists.sort(key=lambda t: len(t[1]), reverse=True)
-            _, submissions = candidate_lists[0]
-
-            # best-effort title
-            title = None
-            if isinstance(assessment, dict):
-                for pth in ("data.title", "title", "data.name", "name"):
-                    cur = assessment
-                    ok = True
-                    for part in pth.split("."):
-                        if isinstance(cur, dict) and part in cur:
-                            cur = cur[part]
-                        else:
-                            ok = False
-                            break
-                    if ok and isinstance(cur, str) and cur.strip():
-                        title = cur.strip()
-                        break
-            # Use raw assessment ID if no title (for upload regex matching)
-            assessment_title = safe_part(title, max_len=60) if title else aid
-
-            for sub in submissions:
-                ts = find_any_timestamp(sub)
-                if ts is not None and ts < since:
-                    continue
+            timeline = get_content_timeline(class_id)
+            assessment_ids = extract_assessment_ids(timeline)
 
-                student_name = safe_part(extract_student_name(sub), max_len=50)
-                student_id = extract_student_id(sub)
+            if DEBUG:
+                log(f"\n[DEBUG] Class {class_name} -> assessment ids: {len(assessment_ids)}")
 
-                atts = extract_attachments(sub)
-                if not atts:
-                    ignored_no_files += 1
+            # Fetch this class's assessments concurrently; PDF downloads are
+            # queued on the same pool and collected once the class is done.
+            pdf_downloads: dict[Future, tuple[str, pathlib.Path]] = {}
+            pdf_duplicates: list[tuple[str, pathlib.Path, Future, pathlib.Path]] = []
+            for aid, assessment in zip(assessment_ids, pool.map(fetch_assessment, assessment_ids)):
+                candidate_lists = find_submission_lists_anywhere(assessment)
+                if not candidate_lists:
                     continue
 
-                # Build a base prefix for filenames
-                prefix = f"{class_name}__{assessment_title}__{student_name}__{student_id}"
-                prefix = re.sub(r"\s+", " ", prefix).strip()
-
-                # 1) Download PDF attachments directly
-                pdf_atts = [a for a in atts if a["kind"] == "pdf"]
-                for a in pdf_atts:
-                    original = safe_part(a["filename"], max_len=90)
-                    out_name = f"{prefix}__{original}"
-                    if not out_name.lower().endswith(".pdf"):
-                        out_name += ".pdf"
-                    out_path = unique_path(DOWNLOAD_ROOT, out_name)
-
-                    try:
-                        download_url(a["url"], out_path)
-                        downloaded_pdfs += 1
-                        print(f"Downloaded PDF: {out_path.name}")
-                    except Exception as e:
-                        print(f"[WARN] PDF download failed: {a['url']} -> {e}")
-
-                # 2) If no PDFs were submitted, but images were, combine images into one PDF
-                if not pdf_atts:
-                    image_atts = [a for a in atts if a["kind"] == "image"]
-                    if image_atts:
-                        tmp_dir = DOWNLOAD_ROOT / "_tmp_images"
-                        tmp_dir.mkdir(parents=True, exist_ok=True)
-
-                        # download images to temp
-                        image_paths: list[pathlib.Path] = []
-                        try:
-                            for idx, a in enumerate(image_atts, start=1):
-                                ext = pathlib.Path(a["filename"]).suffix.lower()
-                                if ext not in IMAGE_EXTS:
-                                    ext = ".jpg"
-                                img_name = f"{prefix}__image_{idx:02d}{ext}"
-                                img_path = unique_path(tmp_dir, img_name)
+                # largest candidate wins; ties go to the first in document order
+                submissions = max(candidate_lists, key=len)
+
+                # best-effort title
+                title = None
+                if isinstance(assessment, dict):
+                    for pth in ("data.title", "title", "data.name", "name"):
+                        cur = assessment
+                        ok = True
+                        for part in pth.split("."):
+                            if isinstance(cur, dict) and part in cur:
+                                cur = cur[part]
+                            else:
+                                ok = False
+                                break
+                        if ok and isinstance(cur, str) and cur.strip():
+                            title = cur.strip()
+                            break
+                # Use raw assessment ID if no title (for upload regex matching)
+                assessment_title = safe_part(title, max_len=60) if title else aid
+
+                for sub in submissions:
+                    ts = find_any_timestamp(sub)
+                    if ts is not None and ts < since:
+                        continue
+
+                    student_name = safe_part(extract_student_name(sub), max_len=50)
+                    student_id = extract_student_id(sub)
+
+                    atts = extract_attachments(sub)
+                    if not atts:
+                        ignored_no_files += 1
+                        continue
+
+                    # Build a base prefix for filenames
+                    prefix = f"{class_name}__{assessment_title}__{student_name}__{student_id}"
+                    prefix = WHITESPACE_RE.sub(" ", prefix).strip()
+
+                    # 1) Download PDF attachments directly
+                    pdf_atts = [a for a in atts if a["kind"] == "pdf"]
+                    for a in pdf_atts:
+                        original = safe_part(a["filename"], max_len=90)
+                        out_name = f"{prefix}__{original}"
+                        if not out_name.lower().endswith(".pdf"):
+                            out_name += ".pdf"
+                        out_path = unique_path(download_root, out_name, taken)
+                        first = pdf_by_key.get(a["s3Key"]) if a["s3Key"] else None
+                        if first:
+                            pdf_duplicates.append((a["url"], out_path, *first))
+                            continue
+                        fut = pool.submit(download_url, a["url"], out_path)
+                        pdf_downloads[fut] = (a["url"], out_path)
+                        if a["s3Key"]:
+                            pdf_by_key[a["s3Key"]] = (fut, out_path)
+
+                    # 2) If no PDFs were submitted, but images were, combine images into one PDF
+                    if not pdf_atts:
+                        image_atts = [a for a in atts if a["kind"] == "image"]
+                        if image_atts:
+                            # images stay in memory; only the combined PDF touches disk
+                            image_downloads = [(a, pool.submit(download_bytes, a["url"])) for a in image_atts]
+                            images: list[bytes] = []
+                            for a, fut in image_downloads:
                                 try:
-                                    download_url(a["url"], img_path)
-                                    image_paths.append(img_path)
+                                    images.append(fut.result())
                                 except Exception as e:
-                                    print(f"[WARN] Image download failed: {a['url']} -> {e}")
+                                    log(f"[WARN] Image download failed: {a['url']} -> {e}")
 
-                            if image_paths:
+                            if images:
                                 out_pdf_name = f"{prefix}__images.pdf"
-                                out_pdf_path = unique_path(DOWNLOAD_ROOT, out_pdf_name)
+                                out_pdf_path = unique_path(download_root, out_pdf_name, taken)
                                 try:
-                                    images_to_pdf(image_paths, out_pdf_path)
+                                    images_to_pdf(images, out_pdf_path)
                                     created_image_pdfs += 1
-                                    print(f"Created PDF from images: {out_pdf_path.name}")
+                                    log(f"Created PDF from images: {out_pdf_path.name}")
                                 except Exception as e:
-                                    print(f"[WARN] Failed to create PDF from images -> {e}")
-                        finally:
-                            # Always clean up temp images
-                            for p in image_paths:
-                                try:
-                                    p.unlink()
-                                except Exception:
-                                    pass
-
-    print("\nDone.")
-    print(f"PDFs downloaded: {downloaded_pdfs}")
-    print(f"PDFs created from images: {created_image_pdfs}")
-    print(f"Submissions ignored (no files): {ignored_no_files}")
+                                    log(f"[WARN] Failed to create PDF from images -> {e}")
+
+            for fut in as_completed(pdf_downloads):
+                url, out_path = pdf_downloads[fut]
+                try:
+                    fut.result()
+                    downloaded_pdfs += 1
+                    log(f"Downloaded PDF: {out_path.name}")
+                except Exception as e:
+                    log(f"[WARN] PDF download failed: {url} -> {e}")
+
+            # Same file (s3Key) as an earlier download: copy it instead of refetching
+            for url, out_path, src_fut, src_path in pdf_duplicates:
+                try:
+                    src_fut.result()
+                    copy_file(src_path, out_path)
+                    downloaded_pdfs += 1
+                    log(f"Downloaded PDF: {out_path.name} (same file as {src_path.name})")
+                except Exception as e:
+                    log(f"[WARN] PDF download failed: {url} -> {e}")
+
+    log("\nDone.")
+    log(f"PDFs downloaded: {downloaded_pdfs}")
+    log(f"PDFs created from images: {created_image_pdfs}")
+    log(f"Submissions ignored (no files): {ignored_no_files}")
+    return 0
+
+
+def main():
+    args = sys.argv[1:]
+    use_cache = "--resume" in args
+    args = [a for a in args if a != "--resume"]
+    days_back = int(args[0]) if args else DEFAULT_DAYS_BACK
+    sys.exit(run(days_back, use_cache=use_cache))
 
 
 if __name__ == "__main__":
@@ -4,11 +4,23 @@ import os
 import re
 import sys
 import time
+import random
 import base64
+import functools
 import pathlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
 # ----------------------------
 # Load env
 # ----------------------------
@@ -20,8 +32,25 @@ WISE_BASE = "https://na-api.wiseapp.live"
 FILE_BASE = "https://na-files.wiseapp.live"
 UA = "VendorIntegrations/jmcg-maths-mentors"
 
+# One keep-alive connection pool for every request this module makes.
+# It lives as long as the module, so repeated runs from the app reuse it.
+# Transient failures on idempotent requests are retried with exponential
+# backoff; the last response is returned so raise_for_status still applies.
+RETRY = Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset({"GET", "PUT"}),
+    raise_on_status=False,
+)
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=RETRY))
+
 MAX_RETRIES = 3
-RETRY_DELAY = 2  # seconds
+RETRY_DELAY = 2  # seconds, base for exponential backoff
+
+# Concurrent uploads (keep <= the session pool size)
+UPLOAD_WORKERS = 8
 
 REQUIRED_ENV_VARS = [
     "WISE_API_KEY",
@@ -31,25 +60,30 @@ REQUIRED_ENV_VARS = [
 ]
 
 
-def validate_env() -> None:
+def validate_env(log: Callable[[str], None] = print) -> bool:
     """Check all required environment variables are set."""
     missing = [k for k in REQUIRED_ENV_VARS if not os.environ.get(k)]
     if missing:
-        print(f"ERROR: Missing environment variables: {', '.join(missing)}")
-        print("Please check your .env file or Streamlit secrets configuration.")
-        sys.exit(1)
+        log(f"ERROR: Missing environment variables: {', '.join(missing)}")
+        log("Please check your .env file or Streamlit secrets configuration.")
+        return False
+    return True
 
 
 # ----------------------------
 # Auth helpers
 # ----------------------------
-def basic_auth_header() -> str:
-    user = os.environ["WISE_BASIC_USER"]
-    pw = os.environ["WISE_BASIC_PASS"]
+@functools.lru_cache(maxsize=1)
+def _encode_basic_auth(user: str, pw: str) -> str:
     token = base64.b64encode(f"{user}:{pw}".encode()).decode()
     return f"Basic {token}"
 
 
+def basic_auth_header() -> str:
+    # Keyed on the credentials, so a changed env still yields a fresh header
+    return _encode_basic_auth(os.environ["WISE_BASIC_USER"], os.environ["WISE_BASIC_PASS"])
+
+
 def headers(json=True):
     h = {
         "User-Agent": UA,
@@ -66,56 +100,67 @@ def headers(json=True):
 # API calls with retry
 # ----------------------------
 def wise_post(path, payload):
-    r = requests.post(
+    r = SESSION.post(
         f"{WISE_BASE}{path}",
         headers=headers(),
         json=payload,
         timeout=60,
     )
     r.raise_for_status()
-    return r.json()
+    return _json.loads(r.content)
 
 
-def upload_file_to_wise(file_path: pathlib.Path) -> dict:
+def wise_post_with_retry(path, payload, label: str, log: Callable[[str], None] = print):
     """
-    Multipart upload to Wise file service with retry logic.
-    Returns file metadata to attach as feedback.
+    wise_post with jittered exponential backoff, for calls that are safe
+    to repeat (the session adapter only retries idempotent methods).
+    label (e.g. the file name) identifies the call in retry messages.
     """
-    last_error = None
-
     for attempt in range(1, MAX_RETRIES + 1):
         try:
-            init = wise_post(
-                "/files/initiateUpload",
-                {
-                    "fileName": file_path.name,
-                    "fileType": "pdf",
-                },
-            )
+            return wise_post(path, payload)
+        except requests.RequestException:
+            if attempt == MAX_RETRIES:
+                raise
+            delay = random.uniform(0, RETRY_DELAY * 2 ** (attempt - 1))
+            log(f"  [Retry {attempt}/{MAX_RETRIES}] {label}: {path} failed, retrying in {delay:.1f}s...")
+            time.sleep(delay)
 
-            upload_url = init["data"]["uploadUrl"]
-            file_key = init["data"]["fileKey"]
 
-            with open(file_path, "rb") as f:
-                r = requests.put(upload_url, data=f, timeout=180)
-                r.raise_for_status()
+def upload_file_to_wise(file_path: pathlib.Path, log: Callable[[str], None] = print) -> dict:
+    """
+    Multipart upload to Wise file service.
+    Each step is retried on its own, so a failed completeUpload doesn't
+    re-send the PDF. Returns file metadata to attach as feedback.
+    """
+    init = wise_post_with_retry(
+        "/files/initiateUpload",
+        {
+            "fileName": file_path.name,
+            "fileType": "pdf",
+        },
+        file_path.name,
+        log,
+    )
 
-            complete = wise_post(
-                "/files/completeUpload",
-                {
-                    "fileKey": file_key,
-                },
-            )
+    upload_url = init["data"]["uploadUrl"]
+    file_key = init["data"]["fileKey"]
+
+    # PUT is retried by the session adapter, which rewinds the file
+    with open(file_path, "rb") as f:
+        r = SESSION.put(upload_url, data=f, timeout=180)
+        r.raise_for_status()
 
-            return complete["data"]
+    complete = wise_post_with_retry(
+        "/files/completeUpload",
+        {
+            "fileKey": file_key,
+        },
+        file_path.name,
+        log,
+    )
 
-        except Exception as e:
-            last_error = e
-            if attempt < MAX_RETRIES:
-                print(f"  [Retry {attempt}/{MAX_RETRIES}] Upload failed, retrying in {RETRY_DELAY}s...")
-                time.sleep(RETRY_DELAY)
-            else:
-                raise last_error
+    return complete["data"]
 
 
 def attach_feedback(assessment_id: str, student_id: str, file_data: dict):
@@ -135,18 +180,25 @@ def attach_feedback(assessment_id: str, student_id: str, file_data: dict):
     )
 
 
+def upload_one(pdf: pathlib.Path, assessment_id: str, student_id: str, log: Callable[[str], None] = print):
+    file_data = upload_file_to_wise(pdf, log)
+    attach_feedback(assessment_id, student_id, file_data)
+
+
 # ----------------------------
 # Filename parsing
 # ----------------------------
 # Format: {class}__{assessmentID}__{student}__{studentID}__{filename} Marked.pdf
 # Assessment ID and Student ID are both 24 hex character MongoDB ObjectIDs
+# Used with fullmatch, so the pattern needs no ^/$ anchors. The trailing
+# part is greedy: it runs to the end once and backs off to " Marked.pdf".
 FILENAME_RE = re.compile(
     r"""
-    ^(?P<class>.+?)__
+    (?P<class>.+?)__
     (?P<assessment>[a-f0-9]{24})__
     (?P<student>.+?)__
     (?P<student_id>[a-f0-9]{24})__
-    .+?\sMarked\.pdf$
+    .+\sMarked\.pdf
     """,
     re.VERBOSE | re.IGNORECASE,
 )
@@ -155,61 +207,76 @@ FILENAME_RE = re.compile(
 # ----------------------------
 # Main
 # ----------------------------
-def main():
-    validate_env()
-    print("=== Upload Marked PDFs ===")
-
-    # Accept folder path from command line argument
-    if len(sys.argv) < 2:
-        print("Usage: python upload_marked.py <folder_path>")
-        print("ERROR: No folder path provided.")
-        sys.exit(1)
-
-    folder = sys.argv[1].strip().strip('"')
-    base = pathlib.Path(folder)
+def run(base: pathlib.Path, log: Callable[[str], None] = print) -> int:
+    """
+    Upload every '* Marked.pdf' in base as assessment feedback.
+    Returns a process-style exit code (0 on success).
+    """
+    if not validate_env(log):
+        return 1
+    log("=== Upload Marked PDFs ===")
 
     if not base.exists():
-        print(f"ERROR: Folder does not exist: {base}")
-        sys.exit(1)
+        log(f"ERROR: Folder does not exist: {base}")
+        return 1
 
     files = list(base.glob("*Marked.pdf"))
     if not files:
-        print("No '* Marked.pdf' files found in folder.")
-        print("Make sure your marked files end with ' Marked.pdf' (with a space before 'Marked').")
-        return
+        log("No '* Marked.pdf' files found in folder.")
+        log("Make sure your marked files end with ' Marked.pdf' (with a space before 'Marked').")
+        return 0
 
-    print(f"Found {len(files)} marked PDFs.\n")
+    log(f"Found {len(files)} marked PDFs.\n")
 
     uploaded = 0
     skipped = 0
     failed = 0
 
-    for i, pdf in enumerate(files, 1):
-        m = FILENAME_RE.match(pdf.name)
+    jobs: list[tuple[pathlib.Path, str, str]] = []
+    for pdf in files:
+        m = FILENAME_RE.fullmatch(pdf.name)
         if not m:
-            print(f"[{i}/{len(files)}] SKIP - Filename format not recognized: {pdf.name}")
+            log(f"SKIP - Filename format not recognized: {pdf.name}")
             skipped += 1
             continue
+        jobs.append((pdf, m.group("assessment"), m.group("student_id")))
+
+    # Uploads run concurrently; results are reported here as they finish
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as pool:
+        futures = {
+            pool.submit(upload_one, pdf, assessment_id, student_id, log): (pdf, student_id)
+            for pdf, assessment_id, student_id in jobs
+        }
+        for i, fut in enumerate(as_completed(futures), 1):
+            pdf, student_id = futures[fut]
+            log(f"[{i}/{len(jobs)}] {pdf.name}")
+            try:
+                fut.result()
+                log(f"  SUCCESS - Feedback attached for student {student_id[:8]}...")
+                uploaded += 1
+            except Exception as e:
+                log(f"  FAILED: {e}")
+                failed += 1
+
+    log("\n" + "=" * 40)
+    log("Upload Complete!")
+    log(f"  Uploaded: {uploaded}")
+    log(f"  Skipped:  {skipped}")
+    log(f"  Failed:   {failed}")
+    log("=" * 40)
+    return 0
 
-        assessment_id = m.group("assessment")
-        student_id = m.group("student_id")
 
-        try:
-            print(f"[{i}/{len(files)}] Uploading: {pdf.name}")
-            file_data = upload_file_to_wise(pdf)
-            attach_feedback(assessment_id, student_id, file_data)
-            print(f"  SUCCESS - Feedback attached for student {student_id[:8]}...")
-            uploaded += 1
-        except Exception as e:
-            print(f"  FAILED: {e}")
-            failed += 1
-
-    print("\n" + "=" * 40)
-    print("Upload Complete!")
-    print(f"  Uploaded: {uploaded}")
-    print(f"  Skipped:  {skipped}")
-    print(f"  Failed:   {failed}")
-    print("=" * 40)
+def main():
+    # Accept folder path from command line argument
+    if len(sys.argv) < 2:
+        print("=== Upload Marked PDFs ===")
+        print("Usage: python upload_marked.py <folder_path>")
+        print("ERROR: No folder path provided.")
+        sys.exit(1)
+
+    folder = sys.argv[1].strip().strip('"')
+    sys.exit(run(pathlib.Path(folder)))
 
 
 if __name__ == "__main__":